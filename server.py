@@ -2,153 +2,276 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import websockets
-import json
+from websockets.frames import Frame, Opcode
+from websockets.protocol import State
+import orjson
+import ormsgpack
 import os
 import sys
 import signal
+import logging
 from datetime import datetime
+from http import HTTPStatus
 
-# Хранилище клиентов
+try:
+    import uvloop  # Быстрый цикл событий на libuv (нет под Windows)
+except ImportError:
+    uvloop = None
+
+class Client:
+    """Подключенный клиент"""
+    __slots__ = ('ws', 'username')
+    
+    def __init__(self, ws, username):
+        self.ws = ws
+        self.username = username
+
+# Хранилище клиентов: client_id -> Client
 clients = {}
+# Вебсокеты тех же клиентов плотными списками — только для рассылки:
+# JSON-клиенты и клиенты, договорившиеся о подпротоколе msgpack
+_ws_list = []
+_msgpack_list = []
+# Текущее время строкой с точностью до секунды, обновляется задачей _tick
+_now_iso = datetime.now().isoformat(timespec='seconds')
+# Окно накопления рассылок, сек.: все фреймы за окно уходят клиенту одной записью
+_BATCH_DELAY = 0.002
+# Готовые фреймы, ожидающие отправки, и запланированный _flush
+_pending = []
+_msgpack_pending = []
+_flush_handle = None
+# Сколько ждем, пока клиент разгрузит переполненный буфер отправки, сек.
+_SEND_TIMEOUT = 5.0
+# Предел буфера отправки клиента, байт: сверх него клиента отключаем сразу
+_MAX_WRITE_BUFFER = 2**20
+# Клиенты с переполненным буфером -> задачи _watch_drain, следящие за ними
+_draining = {}
+# Задачи _reap, ожидающие закрытия соединений
+_reapers = set()
+# Сериализация JSON (orjson возвращает bytes)
+_dumps = orjson.dumps
+# MessagePack для клиентов с подпротоколом msgpack (бинарные фреймы)
+_MSGPACK = 'msgpack'
+_packb = ormsgpack.packb
+_unpackb = ormsgpack.unpackb
+# Готовая обертка системного сообщения: меняется только text
+_SYS_PREFIX = b'{"type":"system","text":"'
+_SYS_SUFFIX = b'"}'
 # Для логирования
-print = lambda *args: sys.stdout.write(' '.join(map(str, args)) + '\n')
+logger = logging.getLogger("chat")
+logger.setLevel(logging.INFO)
 
 async def handler(websocket):
     """Обработчик подключения"""
-    client_id = None
-    username = None
+    # Первое сообщение — информация о пользователе, дальше обычные сообщения
+    joined = False
+    # Формат выбран при подключении: msgpack, если клиент его предложил
+    connections = _connections(websocket)
+    # Локальные имена вместо глобальных/атрибутов на каждом сообщении
+    loads = _unpackb if connections is _msgpack_list else orjson.loads
+    dumps = _dumps
+    publish = broadcast
     
     try:
-        # Ждем первое сообщение (информация о пользователе)
         async for message in websocket:
+            # После входа кадр без подстроки "message" точно не сообщение чата — не разбираем его
+            if joined and isinstance(message, str) and '"message"' not in message:
+                continue
             try:
-                data = json.loads(message)
+                data = loads(message)
+            except ValueError:
+                # Намеренно ValueError: orjson.JSONDecodeError — его подкласс,
+                # а ormsgpack.MsgpackDecodeError и есть ValueError
+                logger.warning("❌ Некорректное сообщение: %r", message)
+                continue
+            try:
+                message_type = data.get('type')
+                
+                if joined:
+                    if message_type == 'message':
+                        # Сериализуем один раз и рассылаем всем
+                        outgoing = {
+                            'type': 'message',
+                            'text': data['text'],
+                            'username': data['username'],
+                            'userId': data['userId'],
+                            'time': _now_iso
+                        }
+                        publish(dumps(outgoing), outgoing)
                 
-                if data['type'] == 'join':
+                elif message_type == 'join':
                     client_id = data.get('userId')
                     username = data.get('username', 'Unknown')
                     
-                    # Сохраняем клиента
-                    clients[client_id] = {
-                        'websocket': websocket,
-                        'username': username,
-                        'joined': datetime.now().isoformat()
-                    }
+                    # Сохраняем клиента (повторный вход с тем же userId вытесняет старое соединение)
+                    previous = clients.get(client_id)
+                    if previous is not None:
+                        _connections(previous.ws).remove(previous.ws)
+                    clients[client_id] = Client(websocket, username)
+                    connections.append(websocket)
+                    # Уберем клиента сразу, как только соединение закроется
+                    reaper = asyncio.create_task(_reap(client_id, websocket))
+                    _reapers.add(reaper)
+                    reaper.add_done_callback(_reapers.discard)
+                    joined = True
                     
-                    print(f"✅ {username} подключился. Всего: {len(clients)}")
+                    logger.info("✅ %s подключился. Всего: %d", username, len(clients))
                     
                     # Отправляем обновленный список всем
-                    await broadcast_users()
-                    await broadcast_system(f"👤 {username} присоединился к чату")
+                    broadcast_users()
+                    broadcast_system(f"👤 {username} присоединился к чату")
                     
-                    # Выходим из цикла ожидания первого сообщения
-                    break
-                    
-            except json.JSONDecodeError:
-                print(f"❌ Получен некорректный JSON: {message}")
-                continue
-        
-        # Теперь обрабатываем обычные сообщения
-        async for message in websocket:
-            try:
-                data = json.loads(message)
-                
-                if data['type'] == 'message':
-                    # Рассылаем сообщение всем
-                    await broadcast(json.dumps({
-                        'type': 'message',
-                        'text': data['text'],
-                        'username': data['username'],
-                        'userId': data['userId'],
-                        'time': datetime.now().isoformat()
-                    }))
-                    
-            except json.JSONDecodeError:
-                print(f"❌ Некорректный JSON: {message}")
             except Exception as e:
-                print(f"❌ Ошибка обработки сообщения: {e}")
+                logger.error("❌ Ошибка обработки сообщения: %s", e)
                 
     except websockets.exceptions.ConnectionClosed as e:
-        print(f"📴 Соединение закрыто: {e}")
+        logger.info("📴 Соединение закрыто: %s", e)
     except Exception as e:
-        print(f"❌ Непредвиденная ошибка: {e}")
-    finally:
-        # Удаляем клиента при отключении
-        if client_id and client_id in clients:
-            user = clients[client_id]['username']
-            del clients[client_id]
-            print(f"❌ {user} отключился. Осталось: {len(clients)}")
-            await broadcast_users()
-            await broadcast_system(f"👋 {user} покинул чат")
-
-async def broadcast_users():
+        logger.error("❌ Непредвиденная ошибка: %s", e)
+
+async def _reap(client_id, websocket):
+    """Удаляем клиента при отключении"""
+    await websocket.wait_closed()
+    client = clients.get(client_id)
+    # Клиента могли уже вытеснить повторным входом с тем же userId
+    if client is None or client.ws is not websocket:
+        return
+    del clients[client_id]
+    _connections(websocket).remove(websocket)
+    logger.info("❌ %s отключился. Осталось: %d", client.username, len(clients))
+    broadcast_users()
+    broadcast_system(f"👋 {client.username} покинул чат")
+
+def broadcast_users():
     """Отправляем всем список пользователей"""
     try:
         users_data = {
-            uid: {'username': data['username']}
-            for uid, data in clients.items()
+            uid: {'username': client.username}
+            for uid, client in clients.items()
         }
         
-        message = json.dumps({
+        message = {
             'type': 'users',
             'users': users_data
-        })
-        
-        await broadcast(message)
+        }
+        # userId приходит от клиента и может быть не строкой — ключи как в json.dumps
+        broadcast(_dumps(message, option=orjson.OPT_NON_STR_KEYS), message)
     except Exception as e:
-        print(f"❌ Ошибка broadcast_users: {e}")
+        logger.error("❌ Ошибка broadcast_users: %s", e)
 
-async def broadcast_system(text):
+def broadcast_system(text):
     """Отправляем системное сообщение"""
     try:
-        await broadcast(json.dumps({
-            'type': 'system',
-            'text': text
-        }))
+        # orjson.dumps(text) — корректно экранированная JSON-строка, срезаем кавычки
+        payload = _SYS_PREFIX + _dumps(text)[1:-1] + _SYS_SUFFIX
+        broadcast(payload, {'type': 'system', 'text': text})
     except Exception as e:
-        print(f"❌ Ошибка broadcast_system: {e}")
+        logger.error("❌ Ошибка broadcast_system: %s", e)
+
+def _connections(websocket):
+    """Список рассылки для соединения по его подпротоколу"""
+    return _msgpack_list if websocket.subprotocol == _MSGPACK else _ws_list
 
-async def broadcast(message):
-    """Отправляем сообщение всем клиентам"""
-    if not clients:
+def select_subprotocol(connection, subprotocols):
+    """Выбираем msgpack, если клиент его предлагает; иначе JSON без подпротокола"""
+    if _MSGPACK in subprotocols:
+        return _MSGPACK
+    return None
+
+def broadcast(payload, message):
+    """Отправляем сообщение всем клиентам (payload — JSON-bytes, message — тот же объект для msgpack)"""
+    global _flush_handle
+    if not _ws_list and not _msgpack_list:
         return
-        
-    # Создаем список задач для отправки
-    tasks = []
-    disconnected = []
     
-    for client_id, client in clients.items():
-        try:
-            tasks.append(client['websocket'].send(message))
-        except Exception:
-            disconnected.append(client_id)
-    
-    # Удаляем отключившихся клиентов
-    for client_id in disconnected:
-        del clients[client_id]
+    # Собираем фрейм (заголовок + данные) один раз на формат и откладываем до _flush,
+    # чтобы сообщения, пришедшие почти одновременно, ушли одной записью
+    if _ws_list:
+        _pending.append(Frame(Opcode.TEXT, payload).serialize(mask=False))
+    if _msgpack_list:
+        # userId в списке пользователей может быть не строкой
+        packed = _packb(message, option=ormsgpack.OPT_NON_STR_KEYS)
+        _msgpack_pending.append(Frame(Opcode.BINARY, packed).serialize(mask=False))
+    if _flush_handle is None:
+        _flush_handle = asyncio.get_running_loop().call_later(_BATCH_DELAY, _flush)
+
+def _flush():
+    """Пишем накопленные фреймы в транспорт каждого клиента"""
+    global _flush_handle
+    _flush_handle = None
+    # Очередь очищаем до записи: при ошибке в _write_all фреймы не уйдут повторно
+    if _pending:
+        data = b''.join(_pending)
+        _pending.clear()
+        _write_all(_ws_list, data)
+    if _msgpack_pending:
+        data = b''.join(_msgpack_pending)
+        _msgpack_pending.clear()
+        _write_all(_msgpack_list, data)
+
+def _write_all(connections, data):
+    """Пишем одни и те же байты в транспорт каждого соединения из списка"""
+    # Локальные имена для цикла по клиентам
+    opened = State.OPEN
+    limit = _MAX_WRITE_BUFFER
+    draining = _draining
     
-    # Отправляем сообщения
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
-
-async def health_check(request):
-    """HTTP-эндпоинт для проверки здоровья"""
-    return websockets.http.Response(
-        status=200,
-        headers={"Content-Type": "text/plain"},
-        body=b"OK\n"
-    )
+    # Повторяет websockets.asyncio.server.broadcast, но с одним общим фреймом;
+    # опирается на внутренние атрибуты соединения, поэтому версия websockets ограничена сверху
+    for websocket in connections:
+        # Пропускаем закрывающиеся соединения и незавершенные фрагментированные отправки
+        if websocket.protocol.state is not opened or websocket.send_in_progress is not None:
+            continue
+        transport = websocket.transport
+        # Не даем одному медленному клиенту раздуть память сервера
+        if transport.get_write_buffer_size() > limit:
+            _evict(websocket, "превысил предел буфера отправки")
+            continue
+        transport.write(data)
+        # Буфер выше лимита — следим за клиентом отдельно, не задерживая остальных
+        if websocket.paused and websocket not in draining:
+            draining[websocket] = asyncio.create_task(_watch_drain(websocket))
+
+async def _watch_drain(websocket):
+    """Отключаем клиента, если он не разгрузил буфер за _SEND_TIMEOUT"""
+    try:
+        await asyncio.wait_for(websocket.drain(), _SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+        _evict(websocket, f"не принимает данные {_SEND_TIMEOUT} с")
+    except ConnectionError:
+        # Соединение оборвалось само — клиента уберет _reap
+        pass
+    finally:
+        del _draining[websocket]
+
+def _evict(websocket, reason):
+    """Обрываем соединение медленного клиента; _reap уберет его после закрытия"""
+    logger.warning("⏳ %s %s, отключаем", websocket.remote_address, reason)
+    websocket.transport.abort()
+
+async def _tick():
+    """Раз в секунду обновляем кэшированное время для сообщений"""
+    global _now_iso
+    while True:
+        _now_iso = datetime.now().isoformat(timespec='seconds')
+        await asyncio.sleep(1)
+
+def health_check(connection, request):
+    """HTTP-эндпоинт для проверки здоровья; остальные пути идут в WebSocket-рукопожатие"""
+    if request.path == "/health":
+        return connection.respond(HTTPStatus.OK, "OK\n")
+    return None
 
 async def main():
     """Основная функция"""
     # Порт из окружения Render или 5000 по умолчанию
     port = int(os.environ.get('PORT', 5000))
     
-    print("=" * 50)
-    print(f"🚀 Чат-сервер запускается...")
-    print(f"📡 Порт: {port}")
-    print(f"⏰ Время: {datetime.now().isoformat()}")
-    print("=" * 50)
+    logger.info("=" * 50)
+    logger.info("🚀 Чат-сервер запускается...")
+    logger.info("📡 Порт: %d", port)
+    logger.info("⏰ Время: %s", datetime.now().isoformat())
+    logger.info("=" * 50)
     
     # Настройка обработки сигналов для graceful shutdown
     loop = asyncio.get_running_loop()
@@ -157,6 +280,9 @@ async def main():
     for sig in (signal.SIGTERM, signal.SIGINT):
         loop.add_signal_handler(sig, stop.set_result, None)
     
+    # Обновляем время для сообщений в фоне
+    tick = asyncio.create_task(_tick())
+    
     # Запускаем сервер
     async with websockets.serve(
         handler,
@@ -165,22 +291,32 @@ async def main():
         ping_interval=20,
         ping_timeout=60,
         close_timeout=30,
+        max_size=2**16,  # Ограничиваем размер входящего сообщения
+        max_queue=16,  # и очередь непрочитанных входящих
+        write_limit=2**16,  # Выше этого буфер отправки считается переполненным
+        compression=None,  # Фреймы собираются заранее, без per-message deflate
+        select_subprotocol=select_subprotocol,  # msgpack по запросу клиента, иначе JSON
         process_request=health_check  # Добавляем health check
     ):
-        print(f"✅ Сервер успешно запущен на порту {port}")
-        print(f"💡 Health check: http://localhost:{port}/health")
-        print("=" * 50)
+        logger.info("✅ Сервер успешно запущен на порту %d", port)
+        logger.info("💡 Health check: http://localhost:%d/health", port)
+        logger.info("=" * 50)
         
         # Ждем сигнала остановки
         await stop
     
-    print("🛑 Сервер остановлен")
+    tick.cancel()
+    logger.info("🛑 Сервер остановлен")
 
 if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, format="%(message)s")
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n🛑 Сервер остановлен пользователем")
+        logger.info("🛑 Сервер остановлен пользователем")
     except Exception as e:
-        print(f"❌ Критическая ошибка: {e}")
+        logger.critical("❌ Критическая ошибка: %s", e)
         sys.exit(1)